@@ -1,12 +1,22 @@
 import streamlit as st
 import pandas as pd
 import requests
-from datetime import datetime, timedelta
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import openmeteo_requests
+from datetime import datetime
+from pathlib import Path
+import os
+import tempfile
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- CONFIGURATION & CONSTANTS ---
 st.set_page_config(page_title="Windscreen Frost Predictor", page_icon="❄️", layout="centered")
 
+CACHE_DIR = Path.home() / ".cache" / "frost"
+
 CAR_TYPES = {
     "Compact / Hatchback": {"factor": 0.8, "icon": "🚗"},
     "Sedan / Saloon": {"factor": 1.0, "icon": "🚙"},
@@ -14,115 +24,264 @@ CAR_TYPES = {
     "Van / Truck": {"factor": 1.5, "icon": "🚚"},
 }
 
+# Indexed by risk_code: (risk, bg_color, text_color, condition)
+RISK_META = (
+    ("None", "#e6f4ea", "green", "Clear"),
+    ("Light Frost", "#fef7e0", "orange", "Frosty"),
+    ("Frost/Ice", "#fce8e6", "red", "Icy"),
+    ("Severe Ice", "#fce8e6", "darkred", "Hard Ice"),
+    ("Fog", "#f1f3f4", "gray", "Foggy"),
+)
+BASE_MINUTES = (0, 5, 10, 15, 2)
+_BASE_MINUTES = np.array(BASE_MINUTES, dtype=np.int8)
+
+# Per-car delay in whole minutes, indexed by risk_code
+_DELAY_TABLE = {
+    name: np.array([round(bm * meta['factor']) for bm in BASE_MINUTES], dtype=np.int8)
+    for name, meta in CAR_TYPES.items()
+}
+
+# Static card styles. Emitted on every full run because Streamlit drops
+# elements that a rerun doesn't re-emit.
+CSS_CARD = """
+<style>
+.weather-card {
+    padding: 8px;
+    border-radius: 10px;
+    text-align: center;
+    border: 1px solid #ddd;
+    display: flex;
+    flex-direction: column;
+    justify-content: center;
+    align-items: center;
+    margin-bottom: 10px; /* Spacing between stacked rows */
+}
+
+.card-small { min-height: 90px; font-size: 0.85em; opacity: 0.9; }
+.card-medium { min-height: 100px; font-size: 0.95em; border-color: #bbb; }
+
+.card-today { 
+    min-height: 110px; 
+    font-size: 1em;
+    border: 2px solid #2962ff; 
+    box-shadow: 0 4px 12px rgba(0,0,0,0.1);
+    z-index: 2;
+}
+
+.card-temp { font-weight: bold; margin: 4px 0; }
+.card-small .card-temp { font-size: 1.0em; }
+.card-medium .card-temp { font-size: 1.1em; }
+.card-today .card-temp { font-size: 1.3em; }
+.card-badge { font-weight: bold; font-size: 0.8em; margin-bottom: 4px; }
+.card-risk { font-weight: 600; font-size: 0.8em; line-height: 1.1; }
+.card-delay { font-size: 0.75em; margin-top: 4px; opacity: 0.7; }
+</style>
+"""
+
+CARD_TMPL = (
+    '<div class="weather-card {size_class}" style="background-color: {bg_color};">'
+    '<div class="card-badge">{badge}</div>'
+    '<div class="card-temp">{temp_c:.1f}°C</div>'
+    '<div class="card-risk" style="color: {text_color};">{risk}</div>'
+    '<div class="card-delay">+{total_delay}m</div>'
+    '</div>'
+)
+
 # --- HELPER FUNCTIONS ---
 
-@st.cache_data(ttl=3600)
-def get_weather_data(lat, lon):
+# Connection holders are shared by reference across reruns and sessions
+@st.cache_resource
+def get_http_session():
+    s = requests.Session()
+    # Only 502/503/504 responses are retried. Connect and read errors fail
+    # straight away, so a hung or unreachable host costs a single timeout=.
+    retry = Retry(total=2, connect=0, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    s.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry))
+    s.headers.update({'Accept-Encoding': 'gzip', 'User-Agent': 'WindscreenFrost/1.0'})
+    return s
+
+@st.cache_resource
+def get_om_client():
+    return openmeteo_requests.Client(session=get_http_session())
+
+def _fetch_weather_data(lat, lon):
     url = "https://api.open-meteo.com/v1/forecast"
     params = {
         "latitude": lat,
         "longitude": lon,
-        "hourly": ["temperature_2m", "relative_humidity_2m", "dew_point_2m", "wind_speed_10m", "weather_code"],
+        "hourly": ["temperature_2m", "relative_humidity_2m", "dew_point_2m", "wind_speed_10m"],
         "timezone": "auto",
+        # The grid renders every 7 AM row, so all 5 past days are shown
         "past_days": 5,
         "forecast_days": 6 
     }
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        
-        hourly = data['hourly']
+        response = get_om_client().weather_api(url, params=params, timeout=10)[0]
+        hourly = response.Hourly()
+
+        # Timestamps arrive as UTC epoch seconds; shift to local wall time
+        offset = response.UtcOffsetSeconds()
+        times = np.arange(hourly.Time() + offset, hourly.TimeEnd() + offset, hourly.Interval(), dtype='int64')
+
+        # Only the 7 AM rows are ever shown, so slice the arrays before
+        # building a frame rather than filtering a full hourly DataFrame
+        keep = (times // 3600) % 24 == 7
+
         df = pd.DataFrame({
-            'time': pd.to_datetime(hourly['time']),
-            'temp_c': hourly['temperature_2m'],
-            'humidity': hourly['relative_humidity_2m'],
-            'dew_point_c': hourly['dew_point_2m'],
-            'wind_speed_kmh': hourly['wind_speed_10m'],
-            'weather_code': hourly['weather_code']
+            'time': times[keep].astype('datetime64[s]'),
+            'temp_c': hourly.Variables(0).ValuesAsNumpy()[keep].astype(np.float32, copy=False),
+            'humidity': hourly.Variables(1).ValuesAsNumpy()[keep].astype(np.float32, copy=False),
+            'dew_point_c': hourly.Variables(2).ValuesAsNumpy()[keep].astype(np.float32, copy=False),
+            'wind_speed_kmh': hourly.Variables(3).ValuesAsNumpy()[keep].astype(np.float32, copy=False)
         })
-        return df
+        # Risk depends only on the weather, so classify once here and let
+        # both cache tiers keep the result
+        return calculate_frost_risk_vec(df)
     except Exception as e:
         st.error(f"Error fetching weather: {e}")
         return pd.DataFrame()
 
-def get_coordinates_from_search(query):
-    try:
-        clean_query = query.strip().replace(" ", "")
-        resp = requests.get(f"https://api.postcodes.io/postcodes/{clean_query}", timeout=3)
-        if resp.status_code == 200:
-            data = resp.json()['result']
-            return data['latitude'], data['longitude'], f"{data['postcode']}, {data.get('admin_district', 'UK')}"
-    except:
-        pass 
+@st.cache_data(ttl=3600)
+def get_weather_data(lat, lon):
+    lat, lon = round(lat, 2), round(lon, 2)
 
+    # Disk tier under the in-memory cache so restarts and other workers
+    # reuse the same hour's fetch. The hour bucket in the name expires it.
+    hour_bucket = datetime.now().strftime('%Y%m%d%H')
+    path = CACHE_DIR / f"frost_{lat}_{lon}_{hour_bucket}.parquet"
     try:
-        resp = requests.get(
-            "https://geocoding-api.open-meteo.com/v1/search",
-            params={"name": query, "count": 1, "language": "en", "format": "json"},
-            timeout=3
-        )
-        if resp.status_code == 200:
-            data = resp.json()
-            if 'results' in data and data['results']:
-                res = data['results'][0]
-                return res['latitude'], res['longitude'], f"{res['name']}, {res.get('country', '')}"
-    except:
+        if path.exists():
+            return pd.read_parquet(path)
+    except Exception:
         pass
-        
+
+    df = _fetch_weather_data(lat, lon)
+    if not df.empty:
+        tmp = None
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # Write to a temp file and rename, so other workers never read a
+            # half-written parquet
+            fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            os.close(fd)
+            df.to_parquet(tmp)
+            os.replace(tmp, path)
+            tmp = None
+            # Drop earlier hours' files so the cache stays bounded
+            for stale in CACHE_DIR.glob("*.parquet"):
+                if not stale.name.endswith(f"_{hour_bucket}.parquet"):
+                    stale.unlink(missing_ok=True)
+        except Exception:
+            pass
+        finally:
+            if tmp:
+                Path(tmp).unlink(missing_ok=True)
+    return df
+
+# Both return None only for a genuine miss (postcode 404, no geocoder
+# results); any other status or request error raises
+def _try_postcode(session, query):
+    clean_query = query.replace(" ", "")
+    resp = session.get(f"https://api.postcodes.io/postcodes/{clean_query}", timeout=3)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)['result']
+    return data['latitude'], data['longitude'], f"{data['postcode']}, {data.get('admin_district', 'UK')}"
+
+def _try_city(session, query):
+    resp = session.get(
+        "https://geocoding-api.open-meteo.com/v1/search",
+        params={"name": query, "count": 1, "language": "en", "format": "json"},
+        timeout=3
+    )
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+    if 'results' in data and data['results']:
+        res = data['results'][0]
+        return res['latitude'], res['longitude'], f"{res['name']}, {res.get('country', '')}"
+    return None
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_coordinates_from_search(query):
+    # Both lookups run at once; a postcode hit wins over a city hit.
+    # "Not found" is only returned when both lookups answered with a miss;
+    # otherwise the error is raised so it isn't cached.
+    session = get_http_session()
+    ex = ThreadPoolExecutor(max_workers=2)
+    try:
+        futs = {ex.submit(_try_postcode, session, query): 'pc', ex.submit(_try_city, session, query): 'city'}
+        results = {}
+        errors = []
+        for fut in as_completed(futs):
+            try:
+                results[futs[fut]] = fut.result()
+            except Exception as e:
+                errors.append(e)
+            if results.get('pc'):
+                break
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    hit = results.get('pc') or results.get('city')
+    if hit:
+        return hit
+    if errors:
+        raise errors[0]
     return None, None, None
 
-def calculate_frost_risk(row):
-    temp = row['temp_c']
-    dew_point = row['dew_point_c']
-    wind = row['wind_speed_kmh']
-    humidity = row['humidity']
+# Failures raise, so they are never cached
+@st.cache_data(ttl=600, show_spinner=False)
+def get_geoip():
+    loc_data = orjson.loads(get_http_session().get('https://ipapi.co/json/', timeout=5).content)
+    return (
+        float(loc_data.get('latitude')),
+        float(loc_data.get('longitude')),
+        f"{loc_data.get('city')}, {loc_data.get('country_name')}",
+    )
+
+def calculate_frost_risk_vec(df):
+    temp = df['temp_c'].to_numpy()
+    dew_point = df['dew_point_c'].to_numpy()
+    wind = df['wind_speed_kmh'].to_numpy()
+    humidity = df['humidity'].to_numpy()
     spread = temp - dew_point
-    
-    risk_level = "None"
-    color = "#e6f4ea" 
-    text_color = "green"
-    minutes_to_clear = 0
-    condition = "Clear"
-
-    if temp <= 3.0: 
-        if spread < 2.0 or (temp <= 0 and humidity > 80):
-            if temp < -5:
-                risk_level = "Severe Ice"
-                color = "#fce8e6"
-                text_color = "darkred"
-                minutes_to_clear = 15
-                condition = "Hard Ice"
-            elif temp <= 0:
-                risk_level = "Frost/Ice"
-                color = "#fce8e6"
-                text_color = "red"
-                minutes_to_clear = 10
-                condition = "Icy"
-            else:
-                risk_level = "Light Frost"
-                color = "#fef7e0"
-                text_color = "orange"
-                minutes_to_clear = 5
-                condition = "Frosty"
-    elif spread < 2.5 and humidity > 90 and wind < 10:
-        risk_level = "Fog"
-        color = "#f1f3f4"
-        text_color = "gray"
-        minutes_to_clear = 2 
-        condition = "Foggy"
-        
-    return pd.Series([risk_level, color, text_color, minutes_to_clear, condition], 
-                     index=['risk', 'bg_color', 'text_color', 'base_minutes', 'condition'])
+
+    cold = temp <= 3.0
+    fog = ~cold & (spread < 2.5) & (humidity > 90) & (wind < 10)
+
+    # Fast path for the common mild case where every row is Clear
+    if not cold.any() and not fog.any():
+        df['risk_code'] = np.zeros(len(df), dtype=np.int8)
+        df['base_minutes'] = np.zeros(len(df), dtype=np.int8)
+        return df
+
+    frost = cold & ((spread < 2.0) | ((temp <= 0) & (humidity > 80)))
+
+    # np.select takes the first match, so the frost tiers go coldest first
+    codes = np.select(
+        [frost & (temp < -5), frost & (temp <= 0), frost, fog],
+        [3, 2, 1, 4],
+        default=0,
+    ).astype(np.int8)
+
+    df['risk_code'] = codes
+    df['base_minutes'] = _BASE_MINUTES[codes]
+    return df
 
 # --- MAIN APP UI ---
 
 st.title("❄️ Windscreen Frost Predictor")
 
+# Emitted outside the forecast fragment so car-type reruns don't resend it
+st.markdown(CSS_CARD, unsafe_allow_html=True)
+
 if 'latitude' not in st.session_state:
     st.session_state.latitude = 51.50 
     st.session_state.longitude = -0.12
     st.session_state.location_name = "London, UK"
+    # Don't fetch until the user picks a location (or asks for the default)
+    st.session_state.forecast_requested = False
 
 with st.container():
     col1, col2 = st.columns([3, 1])
@@ -133,142 +292,114 @@ with st.container():
         st.write("")
         if st.button("🔎 Search"):
             if search_query:
-                lat, lon, name = get_coordinates_from_search(search_query)
-                if lat:
-                    st.session_state.latitude = lat
-                    st.session_state.longitude = lon
-                    st.session_state.location_name = name
-                    st.rerun()
+                try:
+                    # Normalise before the call so the cache key is shared
+                    lat, lon, name = get_coordinates_from_search(search_query.strip().lower())
+                except:
+                    st.warning("Location search failed, please try again.")
                 else:
-                    st.error("Not found.")
+                    if lat:
+                        st.session_state.latitude = lat
+                        st.session_state.longitude = lon
+                        st.session_state.location_name = name
+                        st.session_state.forecast_requested = True
+                        st.rerun()
+                    else:
+                        st.error("Not found.")
 
     if st.button("Use My Current Location"):
         try:
-            loc_req = requests.get('https://ipapi.co/json/', timeout=5)
-            loc_data = loc_req.json()
-            st.session_state.latitude = float(loc_data.get('latitude'))
-            st.session_state.longitude = float(loc_data.get('longitude'))
-            st.session_state.location_name = f"{loc_data.get('city')}, {loc_data.get('country_name')}"
-            st.rerun()
+            lat, lon, name = get_geoip()
         except:
             st.warning("Could not detect location.")
+        else:
+            st.session_state.latitude = lat
+            st.session_state.longitude = lon
+            st.session_state.location_name = name
+            st.session_state.forecast_requested = True
+            st.rerun()
 
+# Car choice lives inside the fragment, so changing it reruns only the
+# report below instead of the whole script.
+@st.fragment
+def render_forecast(morning_df, loc_name):
     car_choice = st.selectbox("Select Car Type", list(CAR_TYPES.keys()))
+    morning_df['total_delay'] = _DELAY_TABLE[car_choice][morning_df['risk_code'].to_numpy()]
+
+    st.divider()
+    st.markdown(f"### Report for **{loc_name}**")
+
+    tomorrow_row = morning_df[morning_df['date_diff'] == 1]
+
+    if not tomorrow_row.empty:
+        row = tomorrow_row.iloc[0]
+        delay = row['total_delay']
+        temp = row['temp_c']
+        risk, _, _, condition = RISK_META[row['risk_code']]
+
+        col_hero_1, col_hero_2 = st.columns([2,1])
+        with col_hero_1:
+            st.subheader("Tomorrow Morning (7:00 AM)")
+            if delay > 0:
+                st.error(f"❄️ Plan for +{delay} minutes delay")
+            else:
+                st.success("✅ Clear Windscreen Expected")
+            st.markdown(f"**{condition}** expected. Temp: **{temp:.1f}°C**")
+        with col_hero_2:
+            st.metric("Risk Level", risk)
+
+    st.divider()
+
+    # --- FORECAST COLUMNS (Native Streamlit) ---
+    st.subheader("📅 11-Day Forecast")
+    st.caption("7:00 AM Snapshot")
+
+    # We use native Streamlit columns.
+    # 6 Columns means it will likely wrap to 2 rows (6 and 5)
+    cols = st.columns(6) 
+
+    # Collect each column's cards and emit them in one markdown call
+    col_parts = [[] for _ in cols]
+    for i, r in enumerate(morning_df.itertuples(index=False)):
+        # Determine Style Class
+        if r.date_diff == 0:
+            size_class = "card-today"
+            badge = "TODAY"
+        elif abs(r.date_diff) == 1:
+            size_class = "card-medium"
+            badge = r.time.strftime('%a %d')
+        else:
+            size_class = "card-small"
+            badge = r.time.strftime('%a %d')
+
+        risk, bg_color, text_color, _ = RISK_META[r.risk_code]
+        card = {
+            'size_class': size_class, 'bg_color': bg_color, 'badge': badge, 'temp_c': r.temp_c,
+            'text_color': text_color, 'risk': risk, 'total_delay': r.total_delay,
+        }
+
+        # Use modulo to cycle through the 6 columns
+        col_parts[i % 6].append(CARD_TMPL.format_map(card))
+
+    for col, parts in zip(cols, col_parts):
+        with col:
+            st.markdown(''.join(parts), unsafe_allow_html=True)
 
 lat = st.session_state.latitude
 lon = st.session_state.longitude
 loc_name = st.session_state.location_name
 
-if lat and lon:
-    df_raw = get_weather_data(lat, lon)
+if not st.session_state.forecast_requested:
+    st.info("Search for a location to see your frost forecast.")
+    if st.button(f"Show forecast for {loc_name}"):
+        st.session_state.forecast_requested = True
+        st.rerun()
+elif lat and lon:
+    # Round before the call (~1 km) so nearby coordinates share a cache entry
+    morning_df = get_weather_data(round(lat, 2), round(lon, 2))
     
-    if not df_raw.empty:
-        risk_cols = df_raw.apply(calculate_frost_risk, axis=1)
-        df = pd.concat([df_raw, risk_cols], axis=1)
-        
-        df['date'] = df['time'].dt.date
-        df['hour'] = df['time'].dt.hour
-        
-        car_factor = CAR_TYPES[car_choice]['factor']
-        df['total_delay'] = (df['base_minutes'] * car_factor).round().astype(int)
-
-        morning_df = df[df['hour'] == 7].copy()
-        
-        st.divider()
-        st.markdown(f"### Report for **{loc_name}**")
-        
-        tomorrow = datetime.now().date() + timedelta(days=1)
-        tomorrow_row = morning_df[morning_df['date'] == tomorrow]
-        
-        if not tomorrow_row.empty:
-            row = tomorrow_row.iloc[0]
-            delay = row['total_delay']
-            
-            col_hero_1, col_hero_2 = st.columns([2,1])
-            with col_hero_1:
-                st.subheader("Tomorrow Morning (7:00 AM)")
-                if delay > 0:
-                    st.error(f"❄️ Plan for +{delay} minutes delay")
-                    st.markdown(f"**{row['condition']}** expected. Temp: **{row['temp_c']}°C**")
-                else:
-                    st.success("✅ Clear Windscreen Expected")
-                    st.markdown(f"**{row['condition']}** expected. Temp: **{row['temp_c']}°C**")
-            with col_hero_2:
-                st.metric("Risk Level", row['risk'])
-
-        st.divider()
-
-        # --- FORECAST COLUMNS (Native Streamlit) ---
-        st.subheader("📅 11-Day Forecast")
-        st.caption("7:00 AM Snapshot")
-        
-        today_date = datetime.now().date()
-        
-        # We use native Streamlit columns.
-        # 6 Columns means it will likely wrap to 2 rows (6 and 5)
-        cols = st.columns(6) 
-
-        # CSS to style the CONTENT inside the native columns
-        st.markdown("""
-        <style>
-        .weather-card {
-            padding: 8px;
-            border-radius: 10px;
-            text-align: center;
-            border: 1px solid #ddd;
-            display: flex;
-            flex-direction: column;
-            justify-content: center;
-            align-items: center;
-            margin-bottom: 10px; /* Spacing between stacked rows */
-        }
-        
-        .card-small { min-height: 90px; font-size: 0.85em; opacity: 0.9; }
-        .card-medium { min-height: 100px; font-size: 0.95em; border-color: #bbb; }
-        
-        .card-today { 
-            min-height: 110px; 
-            font-size: 1em;
-            border: 2px solid #2962ff; 
-            box-shadow: 0 4px 12px rgba(0,0,0,0.1);
-            z-index: 2;
-        }
-        
-        .card-temp { font-weight: bold; margin: 4px 0; }
-        .card-badge { font-weight: bold; font-size: 0.8em; margin-bottom: 4px; }
-        </style>
-        """, unsafe_allow_html=True)
-
-        for index, row in morning_df.iterrows():
-            # Use modulo to cycle through the 6 columns
-            col_idx = index % 6
-            
-            date_diff = (row['date'] - today_date).days
-            
-            # Determine Style Class
-            if date_diff == 0:
-                card_class = "card-today"
-                badge = "TODAY"
-                temp_size = "1.3em"
-            elif abs(date_diff) == 1:
-                card_class = "card-medium"
-                badge = row['date'].strftime('%a %d')
-                temp_size = "1.1em"
-            else:
-                card_class = "card-small"
-                badge = row['date'].strftime('%a %d')
-                temp_size = "1.0em"
-
-            bg_color = row['bg_color']
-            text_color = row['text_color']
-            
-            # Inject HTML card into the specific Streamlit column
-            with cols[col_idx]:
-                st.markdown(f"""
-                <div class="weather-card {card_class}" style="background-color: {bg_color};">
-                    <div class="card-badge">{badge}</div>
-                    <div class="card-temp" style="font-size: {temp_size};">{row['temp_c']}°C</div>
-                    <div style="color: {text_color}; font-weight: 600; font-size: 0.8em; line-height: 1.1;">{row['risk']}</div>
-                    <div style="font-size: 0.75em; margin-top: 4px; opacity: 0.7;">+{row['total_delay']}m</div>
-                </div>
-                """, unsafe_allow_html=True)
+    if not morning_df.empty:
+        today64 = np.datetime64(datetime.now().date())
+        morning_df['date_diff'] = (morning_df['time'].to_numpy().astype('datetime64[D]') - today64).astype('int32')
+
+        render_forecast(morning_df, loc_name)